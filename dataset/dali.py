@@ -0,0 +1,71 @@
+# -*- coding: utf-8
+
+import math
+import os
+
+import pandas as pd
+import torch.nn.functional as F
+from nvidia.dali import fn, pipeline_def, types
+from nvidia.dali.plugin.base_iterator import LastBatchPolicy
+from nvidia.dali.plugin.pytorch import DALIGenericIterator
+
+
+@pipeline_def
+def ava_pipeline(files, labels, shard_id, num_shards, train):
+    """Decode with nvJPEG, Resize(256), RandomCrop(224), (RandomHorizontalFlip), ToTensor on the GPU"""
+    jpegs, labels = fn.readers.file(files=files, labels=labels, shard_id=shard_id, num_shards=num_shards,
+                                    random_shuffle=train, name='Reader')
+    images = fn.decoders.image(jpegs, device='mixed', output_type=types.RGB)
+    images = fn.resize(images, resize_shorter=256)
+    images = fn.crop_mirror_normalize(images,
+                                      crop=(224, 224),
+                                      crop_pos_x=fn.random.uniform(range=(0.0, 1.0)),
+                                      crop_pos_y=fn.random.uniform(range=(0.0, 1.0)),
+                                      mirror=fn.random.coin_flip() if train else 0,
+                                      mean=[0.0, 0.0, 0.0],
+                                      std=[255.0, 255.0, 255.0],
+                                      dtype=types.FLOAT,
+                                      output_layout='HWC')
+    return images, labels.gpu()
+
+
+class AVADALILoader(object):
+    """AVA dataset loaded through an NVIDIA DALI pipeline
+
+    Yields the same {'image', 'style_label'} batches as a DataLoader over AVADataset, already on the GPU
+    and with the images in channels_last memory format.
+
+    Args:
+        csv_file: a csv_file in the AVADataset format, the last columns contain the one-hot style label
+        root_dir: directory to the images
+        batch_size: samples per batch
+        train: shuffle and randomly flip the images
+        device_id: GPU used for decoding and augmentation
+        shard_id: index of this process when the dataset is split between processes
+        num_shards: number of processes the dataset is split between
+        num_threads: CPU threads used by the pipeline
+    """
+
+    def __init__(self, csv_file, root_dir, batch_size, train, device_id=0, shard_id=0, num_shards=1, num_threads=4):
+        annotations = pd.read_csv(csv_file)
+        files = [os.path.join(root_dir, str(name) + '.jpg') for name in annotations.iloc[:, 0]]
+        style_label = annotations.iloc[:, 11:].to_numpy().astype('float')
+        self.num_classes = style_label.shape[1]
+        self.num_batches = math.ceil(math.ceil(len(files) / num_shards) / batch_size)
+
+        pipe = ava_pipeline(files=files, labels=style_label.argmax(axis=1).tolist(),
+                            shard_id=shard_id, num_shards=num_shards, train=train,
+                            batch_size=batch_size, num_threads=num_threads, device_id=device_id)
+        pipe.build()
+        self.iterator = DALIGenericIterator(pipe, ['image', 'style_label'], reader_name='Reader',
+                                            last_batch_policy=LastBatchPolicy.PARTIAL, auto_reset=True)
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        for batch in self.iterator:
+            batch = batch[0]
+            style_label = F.one_hot(batch['style_label'].view(-1).long(), self.num_classes)
+            # NHWC storage viewed as NCHW is channels_last without a copy
+            yield {'image': batch['image'].permute(0, 3, 1, 2), 'style_label': style_label}
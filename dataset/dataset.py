@@ -1,6 +1,7 @@
 # -*- coding: utf-8
 
 import os
+import struct
 
 import pandas as pd
 from PIL import Image
@@ -28,9 +29,13 @@ class AVADataset(data.Dataset):
     def __len__(self):
         return len(self.annotations)
 
+    def _load_image(self, idx):
+        img_name = os.path.join(self.root_dir, str(self.annotations.iloc[idx, 0]) + '.jpg')
+        return Image.open(img_name).convert('RGB')
+
     def __getitem__(self, idx):
         img_name = os.path.join(self.root_dir, str(self.annotations.iloc[idx, 0]) + '.jpg')
-        image = Image.open(img_name).convert('RGB')
+        image = self._load_image(idx)
         annotations = self.annotations.iloc[idx, 1:].to_numpy()
         annotations = annotations.astype('float').reshape(-1, 1)
 
@@ -46,6 +51,35 @@ class AVADataset(data.Dataset):
         return sample
 
 
+class AVADatasetLMDB(AVADataset):
+    """AVA dataset read from an LMDB of pre-decoded images, see build_lmdb in utils/AVA_tools.py
+
+    Args:
+        csv_file: a 11-column csv_file, column one contains the names of image files, column 2-11 contains the empiricial distributions of ratings
+        root_dir: directory to the original images, only used for the img_id of the samples
+        lmdb_path: LMDB holding the resized H × W × 3 uint8 images keyed by image name, each after an 8-byte (H, W) header
+        transform: augmentation of the uint8 3 × H × W image tensors
+    """
+
+    def __init__(self, csv_file, root_dir, lmdb_path, transform=None):
+        super(AVADatasetLMDB, self).__init__(csv_file, root_dir=root_dir, transform=transform)
+        self.lmdb_path = lmdb_path
+        self.env = None
+
+    def _load_image(self, idx):
+        # opened lazily so that every DataLoader worker gets its own handle
+        if self.env is None:
+            import lmdb
+            self.env = lmdb.open(self.lmdb_path, readonly=True, lock=False, readahead=False, meminit=False)
+        img_id = str(self.annotations.iloc[idx, 0])
+        with self.env.begin() as txn:
+            buf = txn.get(img_id.encode())
+        if buf is None:
+            raise KeyError('Image %s not found in %s, rebuild it from the same csv files' % (img_id, self.lmdb_path))
+        h, w = struct.unpack_from('<II', buf)
+        return torch.frombuffer(bytearray(buf[8:]), dtype=torch.uint8).view(h, w, 3).permute(2, 0, 1)
+
+
 if __name__ == '__main__':
 
     # sanity check
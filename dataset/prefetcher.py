@@ -0,0 +1,57 @@
+# -*- coding: utf-8
+
+import torch
+
+
+class CUDAPrefetcher(object):
+    """Copy the next batch to the GPU on a side stream while the current one is being used
+
+    Args:
+        loader: iterable of dict batches, e.g. a DataLoader over AVADataset
+        device: device the tensors of each batch are moved to
+        memory_format: memory format of the 'image' tensor on the device
+        keys: entries of each batch that are moved to the device, the yielded batches only hold these
+    """
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format, keys=('image', 'style_label')):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.keys = keys
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        return {k: batch[k].to(self.device, non_blocking=True,
+                               memory_format=self.memory_format if k == 'image' else torch.preserve_format)
+                for k in self.keys}
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        # the batch may have been produced on the current stream, e.g. already on the GPU
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            return self._to_device(batch)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield self._to_device(batch)
+            return
+
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            for v in batch.values():
+                # the tensors were allocated on the side stream but are used on the current one
+                v.record_stream(current_stream)
+            next_batch = self._preload(loader_iter)
+            yield batch
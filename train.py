@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import contextlib
+import inspect
 import os
+from concurrent.futures import ThreadPoolExecutor
 import torch
+import torch.distributed as dist
 import torch.optim as optim
 import torchvision.transforms as transforms
 from tensorboardX import SummaryWriter
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
 
-from dataset.dataset import AVADataset
+from dataset.dataset import AVADataset, AVADatasetLMDB
+from dataset.prefetcher import CUDAPrefetcher
 
 from model import *
 
@@ -15,9 +22,79 @@ device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 criterion = torch.nn.CrossEntropyLoss()
 
 
+def reduce_mean(value):
+    """Average a python scalar over all processes of the DDP group"""
+    if not (dist.is_available() and dist.is_initialized()):
+        return value
+    value = torch.tensor(value, device=device)
+    dist.all_reduce(value)
+    return value.item() / dist.get_world_size()
+
+
+class AsyncCheckpointer(object):
+    """Save checkpoints from a background thread
+
+    The state_dict is snapshotted into pinned CPU buffers on the calling thread and serialized
+    to disk by a single worker, so training resumes while the file is being written. The outcome of a
+    write is reported by wait(), which runs at the next save and at close.
+
+    Args:
+        half: store floating point tensors as fp16, halving the file size and the pinned buffers
+    """
+
+    def __init__(self, half=False):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.path = None
+        self.buffers = None
+        self.half = half
+
+    def save(self, state_dict, path):
+        # the buffers are reused between saves, let the previous write finish first
+        self.wait()
+        if self.buffers is None:
+            self.buffers = {k: torch.empty(v.shape, dtype=torch.half if self.half and v.is_floating_point() else v.dtype,
+                                           pin_memory=torch.cuda.is_available())
+                            for k, v in state_dict.items()}
+        for k, v in state_dict.items():
+            self.buffers[k].copy_(v, non_blocking=True)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.path = path
+        self.future = self.executor.submit(torch.save, self.buffers, path)
+
+    def wait(self):
+        if self.future is None:
+            return
+        future, self.future = self.future, None
+        try:
+            future.result()
+        except Exception:
+            print('Failed to save model to %s' % self.path)
+            raise
+        print('Model saved to %s' % self.path)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
 def main(config):
+    global device
+
+    # input size is fixed at 224x224, let cuDNN pick the fastest conv algorithms once
+    torch.backends.cudnn.benchmark = True
+
+    if config.multi_gpu:
+        # one process per GPU, launched with torchrun
+        dist.init_process_group(backend='nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    # only the first process logs to tensorboard and writes checkpoints
+    is_main = not config.multi_gpu or dist.get_rank() == 0
 
-    writer = SummaryWriter()
+    writer = SummaryWriter() if is_main else None
 
     train_transform = transforms.Compose([
         transforms.Resize(256),
@@ -30,121 +107,183 @@ def main(config):
         transforms.RandomCrop(224),
         transforms.ToTensor()])
 
+    # images from the LMDB are already decoded and resized uint8 tensors
+    lmdb_train_transform = transforms.Compose([
+        transforms.RandomCrop(224),
+        transforms.RandomHorizontalFlip(),
+        transforms.ConvertImageDtype(torch.float)])
+
+    lmdb_val_transform = transforms.Compose([
+        transforms.RandomCrop(224),
+        transforms.ConvertImageDtype(torch.float)])
+
     model = VGG16BinaryNet()
 
     if config.warm_start:
-        model.load_state_dict(torch.load(os.path.join(config.ckpt_path, 'epoch-%d.pth' % config.warm_start_epoch)))
-        print('Successfully loaded model epoch-%d.pth' % config.warm_start_epoch)
-
+        state_dict = torch.load(os.path.join(config.ckpt_path, 'epoch-%d.pth' % config.warm_start_epoch), map_location='cpu')
+        # checkpoints saved with --fp16_ckpt are cast back to fp32
+        model.load_state_dict({k: v.float() if v.is_floating_point() else v for k, v in state_dict.items()})
+        if is_main:
+            print('Successfully loaded model epoch-%d.pth' % config.warm_start_epoch)
+
+    model = model.to(device, memory_format=torch.channels_last)
+    model_without_ddp = model
     if config.multi_gpu:
-        model.features = torch.nn.DataParallel(model.features, device_ids=[0, 1])
-        model = model.to(device)
+        model = DDP(model, device_ids=[local_rank])
+    if config.compile:
+        # fuse the conv epilogues with TorchInductor, the first steps pay for compilation
+        model = torch.compile(model, mode='max-autotune')
+
+    # fused applies the momentum update of all parameters in a single CUDA kernel,
+    # older torch only has the multi-tensor foreach implementation
+    sgd_params = inspect.signature(optim.SGD).parameters
+    if 'fused' in sgd_params:
+        optimizer_kwargs = {'fused': device.type == 'cuda'}
+    elif 'foreach' in sgd_params:
+        optimizer_kwargs = {'foreach': True}
     else:
-        model = model.to(device)
-
-    optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+        optimizer_kwargs = {}
+    optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9, **optimizer_kwargs)
+    # mixed precision is only available on CUDA, fall back to fp32 elsewhere
+    use_amp = device.type == 'cuda'
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
 
-    param_num = 0
-    for param in model.parameters():
-        if param.requires_grad:
-            param_num += param.numel()
-    print('Trainable params: %.2f million' % (param_num / 1e6))
+    param_num = sum(param.numel() for param in model.parameters() if param.requires_grad)
+    if is_main:
+        print('Trainable params: %.2f million' % (param_num / 1e6))
 
     if config.train:
-        trainset = AVADataset(csv_file=config.train_csv_file, root_dir=config.img_path, transform=train_transform)
-        valset = AVADataset(csv_file=config.val_csv_file, root_dir=config.img_path, transform=val_transform)
-
-        train_loader = torch.utils.data.DataLoader(trainset, batch_size=config.train_batch_size,
-            shuffle=True, num_workers=config.num_workers)
-        val_loader = torch.utils.data.DataLoader(valset, batch_size=config.val_batch_size,
-            shuffle=False, num_workers=config.num_workers)
+        if config.lmdb_path:
+            trainset = AVADatasetLMDB(csv_file=config.train_csv_file, root_dir=config.img_path, lmdb_path=config.lmdb_path, transform=lmdb_train_transform)
+            valset = AVADatasetLMDB(csv_file=config.val_csv_file, root_dir=config.img_path, lmdb_path=config.lmdb_path, transform=lmdb_val_transform)
+        else:
+            trainset = AVADataset(csv_file=config.train_csv_file, root_dir=config.img_path, transform=train_transform)
+            valset = AVADataset(csv_file=config.val_csv_file, root_dir=config.img_path, transform=val_transform)
+
+        # batch sizes are global, every DDP process loads its share of the batch
+        world_size = dist.get_world_size() if config.multi_gpu else 1
+        train_batch_size = config.train_batch_size // world_size
+        val_batch_size = config.val_batch_size // world_size
+
+        if config.dali:
+            # decode and augment on the GPU, requires nvidia-dali
+            from dataset.dali import AVADALILoader
+            shard_id, num_shards = (dist.get_rank(), world_size) if config.multi_gpu else (0, 1)
+            train_sampler = None
+            train_loader = AVADALILoader(csv_file=config.train_csv_file, root_dir=config.img_path,
+                batch_size=train_batch_size, train=True, device_id=torch.cuda.current_device(),
+                shard_id=shard_id, num_shards=num_shards, num_threads=config.num_workers)
+            val_loader = AVADALILoader(csv_file=config.val_csv_file, root_dir=config.img_path,
+                batch_size=val_batch_size, train=False, device_id=torch.cuda.current_device(),
+                shard_id=shard_id, num_shards=num_shards, num_threads=config.num_workers)
+        else:
+            train_sampler = DistributedSampler(trainset) if config.multi_gpu else None
+            val_sampler = DistributedSampler(valset, shuffle=False) if config.multi_gpu else None
+
+            train_loader = torch.utils.data.DataLoader(trainset, batch_size=train_batch_size,
+                shuffle=train_sampler is None, sampler=train_sampler, num_workers=config.num_workers, pin_memory=True,
+                persistent_workers=config.num_workers > 0)
+            val_loader = torch.utils.data.DataLoader(valset, batch_size=val_batch_size,
+                shuffle=False, sampler=val_sampler, num_workers=config.num_workers, pin_memory=True,
+                persistent_workers=config.num_workers > 0)
+            # overlap host to device copies of the next batch with compute on the current one,
+            # DALI batches are already prefetched on the GPU
+            train_loader = CUDAPrefetcher(train_loader, device, memory_format=torch.channels_last)
+            val_loader = CUDAPrefetcher(val_loader, device, memory_format=torch.channels_last)
+
+        if is_main and not os.path.exists(config.ckpt_path):
+            os.makedirs(config.ckpt_path)
+        checkpointer = AsyncCheckpointer(half=config.fp16_ckpt)
         # for early stopping
         count = 0
         init_val_loss = float('inf')
         train_losses = []
         val_losses = []
+        steps_per_epoch = len(train_loader)
         for epoch in range(config.warm_start_epoch, config.epochs):
-            batch_losses = []
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
+            # accumulate on the device, .item() forces a GPU sync
+            loss_sum = torch.zeros((), device=device)
+            loss_count = 0
             batch_acc = []
             for i, data in enumerate(train_loader):
-                images = data['image'].to(device)
-                labels = data['style_label'].to(device).float()
-                outputs = model(images)
-                optimizer.zero_grad()
-
-                # loss, acc = emd_loss(labels, outputs)
-                loss = criterion(outputs, labels)
-                batch_losses.append(loss.item())
-                # batch_acc.append(acc)
-
-                loss.backward()
-                optimizer.step()
-
-                print('Epoch: %d/%d | Step: %d/%d | Training CrossEntropyLoss loss: %.4f' % (epoch + 1, config.epochs, i + 1, len(trainset) // config.train_batch_size + 1, loss.item()))
-                writer.add_scalar('batch train loss', loss.item(), i + epoch * (len(trainset) // config.train_batch_size + 1))
-
-                if (i + 1) % 4 == 0:
-                    batch_val_losses = []
-                    for j, val_data in enumerate(val_loader):
-                        images = val_data['image'].to(device)
-                        labels = val_data['style_label'].to(device).float()
-                        with torch.no_grad():
-                            outputs = model(images)
-                        val_loss = criterion(outputs, labels)
-                        batch_val_losses.append(val_loss.item())
-                    avg_val_loss = sum(batch_val_losses) / (len(valset) // config.val_batch_size + 1)
-                    val_losses.append(avg_val_loss)
-                    print('Epoch %d completed. Mean CrossEntropyLoss loss on val set: %.4f.' % ((i + 1) // 6, avg_val_loss))
-                    if avg_val_loss < init_val_loss:
-                        init_val_loss = avg_val_loss
-                        # save model weights if val loss decreases
-                        print('Saving model...')
-                        if not os.path.exists(config.ckpt_path):
-                            os.makedirs(config.ckpt_path)
-                        torch.save(model.state_dict(),
-                                   os.path.join(config.ckpt_path, 'epoch-%d-%f.pth' % ((i + 1) // 6, avg_val_loss)))
-                        print('Done.\n')
-
-
-            avg_loss = sum(batch_losses) / (len(trainset) // config.train_batch_size + 1)
-            # avg_acc = sum(batch_acc) / (len(trainset) // config.train_batch_size + 1)
+                images = data['image']
+                labels = data['style_label'].float()
+                # update the weights every accum_steps batches and on the last batch of the epoch
+                update = (i + 1) % config.accum_steps == 0 or i + 1 == steps_per_epoch
+                # the last window of the epoch may hold fewer batches
+                accum_window = min(config.accum_steps, steps_per_epoch - i // config.accum_steps * config.accum_steps)
+                # gradients are only all-reduced between processes on update steps
+                sync_context = model.no_sync() if config.multi_gpu and not update else contextlib.nullcontext()
+                with sync_context:
+                    with torch.cuda.amp.autocast(enabled=use_amp):
+                        outputs = model(images)
+                        # loss, acc = emd_loss(labels, outputs)
+                        loss = criterion(outputs, labels)
+
+                    loss_sum += loss.detach()
+                    loss_count += 1
+                    # batch_acc.append(acc)
+
+                    scaler.scale(loss / accum_window).backward()
+
+                if update:
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+
+                if is_main and i % config.log_interval == 0:
+                    batch_loss = loss.item()
+                    print('Epoch: %d/%d | Step: %d/%d | Training CrossEntropyLoss loss: %.4f' % (epoch + 1, config.epochs, i + 1, steps_per_epoch, batch_loss))
+                    writer.add_scalar('batch train loss', batch_loss, i + epoch * steps_per_epoch)
+
+
+            avg_loss = reduce_mean((loss_sum / loss_count).item())
+            # avg_acc = sum(batch_acc) / steps_per_epoch
             train_losses.append(avg_loss)
-            print('Epoch %d mean training CrossEntropyLoss loss: %.4f' % (epoch + 1, avg_loss))
+            if is_main:
+                print('Epoch %d mean training CrossEntropyLoss loss: %.4f' % (epoch + 1, avg_loss))
 
 
             # do validation after each epoch
-            batch_val_losses = []
+            model.eval()
+            val_loss_sum = torch.zeros((), device=device)
+            val_loss_count = 0
             for i, data in enumerate(val_loader):
-                images = data['image'].to(device)
-                labels = data['style_label'].to(device).float()
-                with torch.no_grad():
+                images = data['image']
+                labels = data['style_label'].float()
+                with torch.no_grad(), torch.cuda.amp.autocast(enabled=use_amp):
                     outputs = model(images)
-                val_loss = criterion(outputs, labels)
-                batch_val_losses.append(val_loss.item())
-            avg_val_loss = sum(batch_val_losses) / (len(valset) // config.val_batch_size + 1)
+                    val_loss = criterion(outputs, labels)
+                val_loss_sum += val_loss
+                val_loss_count += 1
+            model.train()
+            avg_val_loss = reduce_mean((val_loss_sum / val_loss_count).item())
             val_losses.append(avg_val_loss)
-            print('Epoch %d completed. Mean CrossEntropyLoss loss on val set: %.4f.' % (epoch + 1, avg_val_loss))
-            writer.add_scalars('epoch losses', {'epoch train loss': avg_loss, 'epoch val loss': avg_val_loss}, epoch + 1)
+            if is_main:
+                print('Epoch %d completed. Mean CrossEntropyLoss loss on val set: %.4f.' % (epoch + 1, avg_val_loss))
+                writer.add_scalars('epoch losses', {'epoch train loss': avg_loss, 'epoch val loss': avg_val_loss}, epoch + 1)
 
             # Use early stopping to monitor training
-            torch.save(model.state_dict(), os.path.join(config.ckpt_path, 'epoch-%d-%f.pth' % (epoch + 1, avg_val_loss)))
-
             if avg_val_loss < init_val_loss:
                 init_val_loss = avg_val_loss
                 # save model weights if val loss decreases
-                print('Saving model...')
-                if not os.path.exists(config.ckpt_path):
-                    os.makedirs(config.ckpt_path)
-                print('Done.\n')
+                if is_main:
+                    checkpointer.save(model_without_ddp.state_dict(), os.path.join(config.ckpt_path, 'epoch-%d-%f.pth' % (epoch + 1, avg_val_loss)))
+                    print('Saving model in background...\n')
                 # reset count
                 count = 0
             elif avg_val_loss >= init_val_loss:
                 count += 1
                 if count == config.early_stopping_patience:
-                    print('Val CrossEntropyLoss loss has not decreased in %d epochs. Training terminated.' % config.early_stopping_patience)
+                    if is_main:
+                        print('Val CrossEntropyLoss loss has not decreased in %d epochs. Training terminated.' % config.early_stopping_patience)
                     break
 
-        print('Training completed.')
+        checkpointer.close()
+        if is_main:
+            print('Training completed.')
 
         '''
         # use tensorboard to log statistics instead
@@ -158,29 +297,35 @@ def main(config):
             plt.savefig('./loss.png')
         '''
 
-    if config.test:
+    if config.test and is_main:
+        # evaluate the unwrapped model on a single process
+        model = model_without_ddp
         model.eval()
         # compute mean score
         test_transform = val_transform
         testset = AVADataset(csv_file=config.test_csv_file, root_dir=config.img_path, transform=val_transform)
-        test_loader = torch.utils.data.DataLoader(testset, batch_size=config.test_batch_size, shuffle=False, num_workers=config.num_workers)
+        test_loader = torch.utils.data.DataLoader(testset, batch_size=config.test_batch_size, shuffle=False, num_workers=config.num_workers, pin_memory=True)
 
         mean_preds = []
         std_preds = []
         for data in test_loader:
-            image = data['image'].to(device)
-            output = model(image)
-            output = output.view(10, 1)
-            predicted_mean, predicted_std = 0.0, 0.0
-            for i, elem in enumerate(output, 1):
-                predicted_mean += i * elem
-            for j, elem in enumerate(output, 1):
-                predicted_std += elem * (j - predicted_mean) ** 2
-            predicted_std = predicted_std ** 0.5
+            image = data['image'].to(device, non_blocking=True, memory_format=torch.channels_last)
+            with torch.no_grad(), torch.cuda.amp.autocast(enabled=use_amp):
+                output = model(image)
+            # one score distribution over 1..num_bins per image of the batch
+            output = output.float().view(output.size(0), -1)
+            scores = torch.arange(1, output.size(1) + 1, device=output.device, dtype=output.dtype)
+            predicted_mean = output @ scores
+            predicted_std = (output * (scores - predicted_mean.unsqueeze(1)) ** 2).sum(dim=1).sqrt()
             mean_preds.append(predicted_mean)
             std_preds.append(predicted_std)
+        mean_preds = torch.cat(mean_preds)
+        std_preds = torch.cat(std_preds)
         # Do what you want with predicted and std...
 
+    if config.multi_gpu:
+        dist.destroy_process_group()
+
 
 if __name__ == '__main__':
 
@@ -188,6 +333,8 @@ if __name__ == '__main__':
 
     # input parameters
     parser.add_argument('--img_path', type=str, default='/home/lab325/gry/Innovative/AVA_dataset/all_images/')
+    # built with `python utils/AVA_tools.py --build_lmdb`, skips JPEG decoding during training
+    parser.add_argument('--lmdb_path', type=str, default=None)
     parser.add_argument('--train_csv_file', type=str, default='./data/2_style_binary_train.csv')
     parser.add_argument('--val_csv_file', type=str, default='./data/2_style_binary_val.csv')
     parser.add_argument('--test_csv_file', type=str, default='./data/2_style_binary_val.csv')
@@ -195,16 +342,23 @@ if __name__ == '__main__':
     # training parameters
     parser.add_argument('--train', action='store_true')
     parser.add_argument('--test', action='store_true')
+    # with --multi_gpu the batch sizes are split evenly between the GPUs
     parser.add_argument('--train_batch_size', type=int, default=156)
+    parser.add_argument('--accum_steps', type=int, default=1, help='batches to accumulate gradients over per optimizer step')
     parser.add_argument('--val_batch_size', type=int, default=100)
     parser.add_argument('--test_batch_size', type=int, default=1)
-    parser.add_argument('--num_workers', type=int, default=2)
+    # loader workers per process, one share of the CPU cores for each GPU
+    parser.add_argument('--num_workers', type=int, default=max(4, (os.cpu_count() or 4) // max(1, torch.cuda.device_count())))
     parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--log_interval', type=int, default=50)
+    parser.add_argument('--dali', action='store_true', help='load training data with an NVIDIA DALI GPU pipeline')
+    parser.add_argument('--compile', action='store_true', help='compile the model with torch.compile (PyTorch 2.x)')
 
     # misc
     parser.add_argument('--ckpt_path', type=str, default='./checkpoint/2')
+    parser.add_argument('--fp16_ckpt', action='store_true', help='save checkpoint weights in fp16')
+    # launch with `torchrun --nproc_per_node=<num_gpus> train.py --multi_gpu=True ...`
     parser.add_argument('--multi_gpu', type=bool, default=False)
-    parser.add_argument('--gpu_ids', type=list, default=[0, 1])
     parser.add_argument('--warm_start', type=bool, default=False)
     parser.add_argument('--warm_start_epoch', type=int, default=0)
     parser.add_argument('--early_stopping_patience', type=int, default=10)
@@ -1,6 +1,8 @@
 import csv
 import os
 import argparse
+import struct
+import numpy as np
 import pandas as pd
 from PIL import Image
 
@@ -177,6 +179,39 @@ def merge_samples(positive_csv, negative_csv, save_path, merge_type):
 
 
 
+# 预先解码图片存入LMDB, 训练时不再解码JPEG
+def build_lmdb(csv_files, img_path, lmdb_path, size=256, commit_interval=1000):
+    import lmdb
+
+    env = lmdb.open(lmdb_path, map_size=1 << 40)
+    txn = env.begin(write=True)
+    count = 0
+    for csv_file in csv_files:
+        print('write ' + csv_file)
+        df = pd.read_csv(csv_file, header=None)
+        for img_id in df[0]:
+            key = str(img_id).encode()
+            if txn.get(key) is not None:
+                continue
+            img = Image.open(os.path.join(img_path, str(img_id) + '.jpg')).convert('RGB')
+            # 与transforms.Resize(size)一致, 短边缩放到size保持长宽比
+            w, h = img.size
+            if w < h:
+                w, h = size, int(size * h / w)
+            else:
+                w, h = int(size * w / h), size
+            img = img.resize((w, h), Image.BILINEAR)
+            # 8字节头记录图片的高和宽, 之后是h × w × 3的uint8数据
+            txn.put(key, struct.pack('<II', h, w) + np.asarray(img, dtype=np.uint8).tobytes())
+            count += 1
+            if count % commit_interval == 0:
+                txn.commit()
+                txn = env.begin(write=True)
+    txn.commit()
+    env.close()
+    print('%d images written to %s' % (count, lmdb_path))
+
+
 def main(args):
     if args.test_tool:
         test_tool()
@@ -215,6 +250,11 @@ def main(args):
                       args.save_merge_csv_path,
                       args.merge_type)
 
+    if args.build_lmdb:
+        build_lmdb(args.lmdb_csv_files,
+                   args.lmdb_img_path,
+                   args.lmdb_path)
+
 
 if __name__ == '__main__':
     # todo 可以加一个判断path最后是否是‘/’，如果不是则拼接‘/’
@@ -263,6 +303,13 @@ if __name__ == '__main__':
     parser.add_argument('--save_merge_csv_path', type=str, default='/home/lab325/gry/gry-graduation/style-binary-classification/data/2_style_binary_train.csv')
     parser.add_argument('--merge_type', type=str, default='train')
 
+    # decode the images once into an LMDB of uint8 arrays resized to a shorter side of 256
+    parser.add_argument('--build_lmdb', action='store_true')
+    parser.add_argument('--lmdb_csv_files', type=str, nargs='+', default=['/home/lab325/gry/gry-graduation/style-binary-classification/data/2_style_binary_train.csv',
+                                                                         '/home/lab325/gry/gry-graduation/style-binary-classification/data/2_style_binary_val.csv'])
+    parser.add_argument('--lmdb_img_path', type=str, default='/home/lab325/gry/Innovative/AVA_dataset/all_images/')
+    parser.add_argument('--lmdb_path', type=str, default='/home/lab325/gry/Innovative/AVA_dataset/all_images_256.lmdb')
+
 
     arguments = parser.parse_args()
     main(arguments)